@@ -2,47 +2,210 @@
 
 import json
 import socket
+import time
+from collections import OrderedDict
+
+from geohash_tools import geohash
+
+
+class ReplyCache():
+    " LRU cache of server replies keyed on geohash prefix, entries expire after ttl seconds. "
+
+    def __init__(self, max_size=10000, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()  # prefix -> (expires, reply)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expired = 0
+
+    def get(self, prefix):
+        entry = self.entries.get(prefix)
+        if entry is None:
+            self.misses += 1
+            return None
+        if entry[0] < time.monotonic():
+            del self.entries[prefix]
+            self.expired += 1
+            self.misses += 1
+            return None
+        self.entries.move_to_end(prefix)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, prefix, reply):
+        self.entries[prefix] = (time.monotonic() + self.ttl, reply)
+        self.entries.move_to_end(prefix)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"size": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expired": self.expired}
 
 
 class GeohashClient():
-    def __init__(self, ip="127.0.0.1", port=9999):
+    def __init__(self, ip="127.0.0.1", port=9999, cache_size=0, cache_ttl=300, cache_precision=8,
+                 unix_socket=None, udp=False, udp_timeout=1.0):
+        """
+        cache_size > 0 answers repeated cells locally without asking the server.
+        The cache key is the first cache_precision characters of the geohash, set it to the precision of the database.
+        unix_socket connects to the servers --unix-socket path instead of ip and port.
+        udp sends every query as one datagram to the servers --udp-port, lost datagrams raise socket.timeout.
+        """
         self.connected = False
         self.server_ip = ip
         self.server_port = port
+        self.unix_socket = unix_socket
+        self.udp = udp
+        self.udp_timeout = udp_timeout
+        self.buffer_size = 65535 if udp else 4096  # A datagram has to be read in one recv
+        self.request_id = 0  # Sent with udp requests, the server echoes it in front of the reply
+        self.cache_precision = cache_precision
+        self.cache = ReplyCache(max_size=cache_size, ttl=cache_ttl) if cache_size else None
         self.connect(ip=ip, port=port)
 
     def connect(self, ip="127.0.0.1", port=9999):
-        self.connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)  # Set up TCP/IP Socket to server
-        self.connection.connect((ip, port))
+        if self.unix_socket:
+            self.connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.connection.connect(self.unix_socket)
+        elif self.udp:
+            self.connection = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.connection.settimeout(self.udp_timeout)
+            self.connection.connect((ip, port))  # Only fixes the peer, no packets are sent
+        else:
+            self.connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)  # Set up TCP/IP Socket to server
+            self.connection.connect((ip, port))
         self.reply = ""
         self.connected = True
 
     def disconnect(self):
-        command = json.dumps({"cmd": "disconnect"})
-        self.connection.send(command.encode())
+        if self.udp:
+            self.connection.close()
+        else:
+            command = json.dumps({"cmd": "disconnect"})
+            self.connection.send(command.encode())
         self.connected = False
 
-    def query_geohash(self, _geohash):
-        command = json.dumps({"cmd": "geohash",
-                              "data": _geohash})
-        self.connection.sendall(command.encode("utf8"))
-        reply = self.connection.recv(4096).decode("utf8")
+    def send_request(self, command_dict):
+        " udp requests get a new id, so a late reply to an earlier request is never taken for this one. "
+        if self.udp:
+            self.request_id += 1
+            command_dict["id"] = self.request_id
+        self.connection.sendall(json.dumps(command_dict).encode("utf8"))
+
+    def recv_udp_reply(self):
+        " Replies are the request id, a newline and the reply, replies to earlier requests are dropped. "
+        expected_id = str(self.request_id).encode("utf8")
+        while True:
+            reply = self.connection.recv(self.buffer_size)  # Raises socket.timeout when the reply is lost
+            request_id, _, reply = reply.partition(b"\n")
+            if request_id == expected_id:
+                return reply.decode("utf8", errors="replace")
+
+    def recv_single_reply(self):
+        " Single query replies fit in one recv. "
+        if self.udp:
+            return self.recv_udp_reply()
+        return self.connection.recv(self.buffer_size).decode("utf8")
+
+    def recv_reply(self):
+        " Batch replies can be larger than one recv, read until the json is complete. "
+        if self.udp:
+            return self.recv_udp_reply()
+        reply = self.connection.recv(self.buffer_size)
+        while reply[:1] in (b"{", b"["):  # Errors are plain text and always fit in one recv
+            try:
+                decoded_reply = reply.decode("utf8")
+                json.loads(decoded_reply)
+                return decoded_reply
+            except (json.JSONDecodeError, UnicodeDecodeError):
+                chunk = self.connection.recv(65536)
+                if not chunk:
+                    break
+                reply += chunk
+        return reply.decode("utf8", errors="replace")
+
+    def send_command(self, command_dict):
+        " Sends any command dict, returns the reply string. "
+        self.send_request(command_dict)
+        return self.recv_reply()
+
+    def query_batch(self, queries):
+        """
+        Takes a list of geohash strings and (lat, lon) tuples, returns a json list with one result per query.
+        """
+        batch = []
+        for query in queries:
+            if isinstance(query, str):
+                batch.append({"cmd": "geohash", "data": query})
+            else:
+                batch.append({"cmd": "latlon", "data": str(query[0]) + "," + str(query[1])})
+        self.send_request({"cmd": "batch",
+                           "data": batch})
+        return self.recv_reply()
+
+    def cache_stats(self):
+        if self.cache is None:
+            return None
+        return self.cache.stats()
+
+    def command_with_layer(self, command_dict, layer):
+        " layer selects a server dataset by name, a list of names returns the result of each. "
+        if layer is not None:
+            command_dict["layer"] = layer
+        return command_dict
+
+    def cache_key(self, prefix, layer):
+        return prefix if layer is None else (str(layer), prefix)
+
+    def query_geohash(self, _geohash, layer=None):
+        prefix = None
+        if self.cache is not None and len(_geohash) >= self.cache_precision:
+            prefix = self.cache_key(_geohash[:self.cache_precision], layer)
+            reply = self.cache.get(prefix)
+            if reply is not None:
+                return reply
+        self.send_request(self.command_with_layer({"cmd": "geohash",
+                                                   "data": _geohash}, layer))
+        reply = self.recv_reply() if isinstance(layer, list) else self.recv_single_reply()
+        if prefix is not None and reply.startswith("{"):  # Errors are not cached
+            self.cache.put(prefix, reply)
         return reply
 
-    def query_lat_lon(self, lat, lon):
+    def query_lat_lon(self, lat, lon, layer=None):
         """ Takes two input parameters, latitude and longitude, returns geohash"""
+        prefix = None
+        if self.cache is not None:
+            prefix = geohash.encode(float(lat), float(lon), precision=self.cache_precision)  # Same encoding as the server
+            prefix = self.cache_key(prefix, layer)
+            reply = self.cache.get(prefix)
+            if reply is not None:
+                return reply
         string_latlon = str(lat) + "," + str(lon)
-        command = json.dumps({"cmd": "latlon",
-                              "data": string_latlon})
-        self.connection.sendall(command.encode("utf8"))
-        reply = self.connection.recv(4096).decode("utf8")
+        self.send_request(self.command_with_layer({"cmd": "latlon",
+                                                   "data": string_latlon}, layer))
+        reply = self.recv_reply() if isinstance(layer, list) else self.recv_single_reply()
+        if prefix is not None and reply.startswith("{"):
+            self.cache.put(prefix, reply)
         return reply
 
+    def query_region(self, lat, lon):
+        " Returns the admin region and country from the servers admin boundary polygons. "
+        return self.send_command({"cmd": "region",
+                                  "data": str(lat) + "," + str(lon)})
+
     def __query_status(self):
-        command = json.dumps({"cmd": "geohash",
-                              "data": "gcpuvr71"})  # Is London still there?
-        self.connection.sendall(command.encode("utf8"))
-        reply = self.connection.recv(4096).decode("utf8")
+        self.send_request({"cmd": "geohash",
+                           "data": "gcpuvr71"})  # Is London still there?
+        reply = self.recv_single_reply()
         return reply
 
     def connected(self):
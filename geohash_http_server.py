@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+"""
+HTTP/1.1 front end for the geohash server.
+Uses the same process_input engine as the json socket protocol, so results are identical.
+
+GET  /reverse?lat=59.33&lon=18.06   -> {"city": ..., "admin": ..., "country": ..., "precision": ..., "hits": ...}
+GET  /geohash/u6sce14m              -> same as above
+GET  /region?lat=59.33&lon=18.06    -> {"admin": ..., "country": ..., "method": ...}, needs --polygons
+GET  /reverse?lat=59.33&lon=18.06&layer=geonames,poi -> {"layers": {"geonames": {...}, "poi": {...}}}
+POST /batch                         -> json list or ndjson of queries, answered in the same format
+
+Batch items can be {"cmd": "latlon", "data": "lat,lon"}, {"cmd": "geohash", "data": "u6sce14m"},
+{"lat": 59.33, "lon": 18.06} or {"geohash": "u6sce14m"}, all with an optional "layer".
+
+Connections are kept alive and pipelined requests are answered in order.
+Every connection has its own thread, lookups take a cursor from the dataset's pool (see geohash_datasets.Dataset.query)
+so concurrent connections never share a sqlite3 cursor.
+"""
+
+import json
+import logging
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+MAX_BODY_SIZE = 4 * 1024 * 1024
+BATCH_COMMANDS = ("latlon", "geohash", "region")  # Admin commands like stats and profile are not served over HTTP
+
+logger = logging.getLogger()
+
+
+def http_item_to_input_dict(item):
+    " Converts a batch item to the input_dict format that process_input expects, None for items that are not queries. "
+    if not isinstance(item, dict):
+        return None
+    if "cmd" in item:
+        return item if item["cmd"] in BATCH_COMMANDS else None
+    if "geohash" in item:
+        input_dict = {"cmd": "geohash", "data": str(item["geohash"])}
+    elif "lat" in item and "lon" in item:
+        input_dict = {"cmd": "latlon", "data": f"{item['lat']},{item['lon']}"}
+    else:
+        return None
+    if "layer" in item:
+        input_dict["layer"] = item["layer"]
+    return input_dict
+
+
+def query_layer(query):
+    " ?layer=poi selects one dataset, ?layer=geonames,poi answers from several. "
+    if "layer" not in query:
+        return None
+    layers = query["layer"][0].split(",")
+    return layers if len(layers) > 1 else layers[0]
+
+
+def parse_batch_body(body, content_type):
+    """
+    Returns (list_of_items, is_ndjson).
+    A body that parses as a json list is a json batch, anything else is treated as ndjson.
+    """
+    text = body.decode("utf8")
+    if "ndjson" not in content_type:
+        try:
+            items = json.loads(text)
+            if isinstance(items, list):
+                return items, False
+        except json.JSONDecodeError:
+            pass
+    items = [json.loads(line) for line in text.splitlines() if line.strip()]
+    return items, True
+
+
+class GeohashHTTPRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive by default
+    disable_nagle_algorithm = True  # Small replies should not wait for delayed ACKs
+    server_version = "geohash_server"
+
+    def log_message(self, format, *args):
+        logger.debug("HTTP %s " + format, self.address_string(), *args)
+
+    def send_body(self, status, body, content_type="application/json"):
+        body = body.encode("utf8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_json(self, status, message):
+        self.send_body(status, json.dumps({"error": message}))
+
+    def send_result(self, result):
+        " process_input returns json on success and a plain message on failure. "
+        if result.startswith("{"):
+            self.send_body(200, result)
+        else:
+            self.send_error_json(400, result)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        if url.path in ("/reverse", "/region"):
+            try:
+                lat = float(query["lat"][0])
+                lon = float(query["lon"][0])
+            except (KeyError, ValueError):
+                self.send_error_json(400, "lat and lon are required")
+                return
+            input_dict = {"cmd": "latlon" if url.path == "/reverse" else "region", "data": f"{lat},{lon}"}
+        elif url.path.startswith("/geohash/"):
+            input_dict = {"cmd": "geohash", "data": url.path[len("/geohash/"):]}
+        else:
+            self.send_error_json(404, "Not found")
+            return
+        layer = query_layer(query)
+        if layer is not None:
+            input_dict["layer"] = layer
+        self.send_result(self.server.process_function(input_dict, self.server.datasets))
+
+    def do_POST(self):
+        if urlsplit(self.path).path != "/batch":
+            self.send_error_json(404, "Not found")
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            length = -1
+        if length < 0 or length > MAX_BODY_SIZE:
+            self.close_connection = True
+            self.send_error_json(413, "Invalid Content-Length")
+            return
+        body = self.rfile.read(length)
+        try:
+            items, is_ndjson = parse_batch_body(body, self.headers.get("Content-Type", ""))
+        except (UnicodeDecodeError, json.JSONDecodeError) as e:
+            self.send_error_json(400, f"Could not parse batch: {e}")
+            return
+        batch = [http_item_to_input_dict(item) for item in items]
+        result = self.server.process_function({"cmd": "batch", "data": batch}, self.server.datasets)
+        if not result.startswith("["):
+            self.send_error_json(400, result)
+        elif is_ndjson:
+            lines = "".join(json.dumps(item) + "\n" for item in json.loads(result))
+            self.send_body(200, lines, content_type="application/x-ndjson")
+        else:
+            self.send_body(200, result)
+
+
+def start_http_server(ip, port, datasets, process_function):
+    " Serves HTTP until the process exits, every connection gets its own thread. "
+    http_server = ThreadingHTTPServer((ip, port), GeohashHTTPRequestHandler)
+    http_server.daemon_threads = True
+    http_server.datasets = datasets
+    http_server.process_function = process_function
+    logger.info(f"HTTP server listening on port {str(port)}")
+    http_server.serve_forever()
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+
+"""
+Routes geohash queries to several geohash_server backends by geohash prefix range.
+Speaks the same json protocol as geohash_server, so GeohashClient works unchanged.
+
+Build shards from a database, one database file per shard and a shard map:
+    python3 geohash_router.py --build-shards 4 --database geohash_worldcities.db --shard-dir ./shards
+Start one geohash_server per shard:
+    python3 geohash_server.py --port 10000 --database ./shards/shard_0.db
+Start the router:
+    python3 geohash_router.py --shard-map ./shards/shard_map.json --port 9999
+
+Batches are split per shard, sent to the shards in parallel and merged in the original order.
+Backends are health checked in the background and connections to them are pooled.
+"""
+
+import argparse
+import json
+import logging
+import os
+import queue
+import socket
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import geohash_client
+import geohash_server
+from geohash_tools import geohash, geohash_shards, geohash_sqlite3
+
+HEALTH_CHECK_INTERVAL = 5  # Seconds
+BACKEND_TIMEOUT = 5  # Seconds
+
+logger = logging.getLogger()
+
+
+class BackendPool():
+    " A pool of open GeohashClient connections to one backend. "
+
+    def __init__(self, address, max_idle=32):
+        ip, port = address.rsplit(":", 1)
+        self.address = address
+        self.ip = ip
+        self.port = int(port)
+        self.healthy = True
+        self.idle = queue.LifoQueue(maxsize=max_idle)
+
+    def acquire(self):
+        " Returns (client, reused), new connections are only opened when no idle connection is left. "
+        try:
+            return self.idle.get_nowait(), True
+        except queue.Empty:
+            pass
+        try:
+            client = geohash_client.GeohashClient(ip=self.ip, port=self.port)
+        except OSError as e:
+            raise ConnectionError(f"{self.address}: {e}")
+        client.connection.settimeout(BACKEND_TIMEOUT)
+        return client, False
+
+    def release(self, client):
+        try:
+            self.idle.put_nowait(client)
+        except queue.Full:
+            client.disconnect()
+
+    def send_command(self, command_dict):
+        " Returns the reply, raises ConnectionError if the backend did not answer. "
+        while True:
+            client, reused = self.acquire()
+            try:
+                reply = client.send_command(command_dict)
+            except OSError as e:
+                reply = ""
+                error = e
+            else:
+                error = "connection closed"
+            if reply:
+                self.release(client)
+                return reply
+            client.connection.close()
+            if not reused:  # Pooled connections can have been closed by the backend, retry with a new one
+                raise ConnectionError(f"{self.address}: {error}")
+
+    def health_check(self):
+        try:
+            self.send_command({"cmd": "geohash", "data": "gcpuvr71"})
+            healthy = True
+        except ConnectionError:
+            healthy = False
+        if healthy != self.healthy:
+            logger.info(f"Backend {self.address} is {'healthy' if healthy else 'unhealthy'}")
+        self.healthy = healthy
+
+
+class Router():
+    def __init__(self, shard_map):
+        self.shard_router = geohash_shards.ShardRouter(shard_map)
+        self.shard_pools = [[BackendPool(address) for address in shard["backends"]]
+                            for shard in self.shard_router.shards]
+        self.next_backend = 0
+        self.executor = ThreadPoolExecutor(max_workers=max(len(self.shard_pools), 1) * 4)
+
+    def health_check_loop(self):
+        while True:
+            for pools in self.shard_pools:
+                for pool in pools:
+                    pool.health_check()
+            threading.Event().wait(HEALTH_CHECK_INTERVAL)
+
+    def shard_of(self, input_dict):
+        " Returns the shard index for a query, queries that can not be routed go to the first shard which reports the error. "
+        try:
+            if input_dict["cmd"] == "geohash":
+                return self.shard_router.shard_index(input_dict["data"])
+            if input_dict["cmd"] == "latlon":
+                lat, lon = input_dict["data"].split(",")
+                return self.shard_router.shard_index(geohash.encode(float(lat), float(lon)))
+        except (AttributeError, KeyError, TypeError, ValueError):
+            pass
+        return 0
+
+    def send_to_shard(self, shard_index, command_dict):
+        " Tries the healthy backends of the shard first, round robin between replicas. "
+        pools = self.shard_pools[shard_index]
+        if not pools:
+            return f"ERROR: No backend configured for shard {shard_index}"
+        self.next_backend += 1
+        ordered = pools[self.next_backend % len(pools):] + pools[:self.next_backend % len(pools)]
+        ordered.sort(key=lambda pool: not pool.healthy)
+        for pool in ordered:
+            try:
+                reply = pool.send_command(command_dict)
+                pool.healthy = True
+                return reply
+            except ConnectionError as e:
+                logger.error(f"Backend failed {e}")
+                pool.healthy = False
+        return f"ERROR: No backend available for shard {shard_index}"
+
+    def process_batch(self, batch_list):
+        " Splits the batch per shard, queries the shards in parallel and merges the replies in order. "
+        if not isinstance(batch_list, list):
+            return "ERROR: Batch data must be a list of queries"
+        positions = {}
+        for position, item in enumerate(batch_list):
+            shard_index = self.shard_of(item) if isinstance(item, dict) else 0
+            positions.setdefault(shard_index, []).append(position)
+        futures = {shard_index: self.executor.submit(self.send_to_shard, shard_index,
+                                                     {"cmd": "batch",
+                                                      "data": [batch_list[position] for position in shard_positions]})
+                   for shard_index, shard_positions in positions.items()}
+        results = [None] * len(batch_list)
+        for shard_index, future in futures.items():
+            reply = future.result()
+            try:
+                shard_results = json.loads(reply)
+            except json.JSONDecodeError:
+                shard_results = [{"error": reply}] * len(positions[shard_index])
+            for position, result in zip(positions[shard_index], shard_results):
+                results[position] = result
+        return json.dumps(results)
+
+    def stats(self):
+        return json.dumps({"shards": [{"start": shard["start"],
+                                       "end": shard["end"],
+                                       "backends": {pool.address: {"healthy": pool.healthy,
+                                                                   "idle_connections": pool.idle.qsize()}
+                                                    for pool in pools}}
+                                      for shard, pools in zip(self.shard_router.shards, self.shard_pools)]})
+
+    def process_input(self, input_dict):
+        " Returns the reply, errors are returned as a message like geohash_server.process_input does. "
+        try:
+            if input_dict["cmd"] == "batch":
+                return self.process_batch(input_dict["data"])
+            if input_dict["cmd"] == "stats":
+                return self.stats()
+            return self.send_to_shard(self.shard_of(input_dict), input_dict)
+        except Exception as e:
+            error_msg = f"ERROR: Router could not process request {e!r}"
+            logger.error(error_msg)
+            return error_msg
+
+
+def router_client_thread(connection, ip, router, MAX_BUFFER_SIZE=4096):
+    listening = True
+    while listening:
+        input_dict = geohash_server.recieve_input_from_client(connection, MAX_BUFFER_SIZE)
+        if input_dict["cmd"] == "disconnect":
+            connection.close()
+            logger.info(f"Connection from {str(ip)} ended")
+            listening = False
+        else:
+            try:
+                geohash_server.return_data_to_client(connection, router.process_input(input_dict))
+            except BrokenPipeError:
+                logger.error("Client disconnected.")
+                listening = False
+
+
+def start_router(ip, port, router):
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+        server_socket.bind((ip, port))
+    except Exception as e:
+        logger.error(f"Creating socket {e}")
+        sys.exit(1)
+    server_socket.listen(10)
+    threading.Thread(target=router.health_check_loop, daemon=True).start()
+    logger.info(f"Router listening on port {str(port)}")
+    try:
+        while True:
+            connection, address = server_socket.accept()
+            logger.info(f"Client {address[0]} {address[1]} connected.")
+            threading.Thread(target=router_client_thread, args=(connection, address[0], router), daemon=True).start()
+    except KeyboardInterrupt:
+        logger.info("SIGINT shutting down router.")
+        server_socket.close()
+        sys.exit(0)
+
+
+def build_shards(database, shard_count, shard_dir, first_backend_port):
+    " Writes shard_0.db .. shard_N.db and shard_map.json with one local backend port per shard. "
+    os.makedirs(shard_dir, exist_ok=True)
+    cursor = geohash_sqlite3.load_sqlite3_file(database)
+    backends = [[f"127.0.0.1:{first_backend_port + index}"] for index in range(shard_count)]
+    shard_map = geohash_shards.build_shard_map(cursor, shard_count, backends)
+    for index, shard in enumerate(shard_map["shards"]):
+        shard_file = os.path.join(shard_dir, f"shard_{index}.db")
+        shard["database"] = shard_file
+        logger.info(f"Writing {shard_file} with prefixes [{shard['start']}, {shard['end']})")
+        geohash_shards.export_shard_sqlite3(cursor, shard_file, shard["start"], shard["end"])
+    shard_map_file = os.path.join(shard_dir, "shard_map.json")
+    geohash_shards.write_shard_map(shard_map, shard_map_file)
+    logger.info(f"Wrote {shard_map_file}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Routes geohash queries to sharded geohash servers.")
+    parser.add_argument("--ip", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9999)
+    parser.add_argument("--shard-map", help="Shard map json file.")
+    parser.add_argument("--build-shards", type=int, metavar="N", help="Split --database into N shards and exit.")
+    parser.add_argument("--database", default=geohash_server.GEOHASH_SQLITE3_FILE)
+    parser.add_argument("--shard-dir", default="./shards")
+    parser.add_argument("--first-backend-port", type=int, default=10000)
+    args = parser.parse_args()
+    if args.build_shards:
+        build_shards(args.database, args.build_shards, args.shard_dir, args.first_backend_port)
+        return
+    if not args.shard_map:
+        parser.error("--shard-map is required unless --build-shards is given")
+    router = Router(geohash_shards.load_shard_map(args.shard_map))
+    start_router(args.ip, args.port, router)
+
+
+if __name__ == "__main__":
+    main()
@@ -10,22 +10,35 @@ TODO: Shut down in a nicer way.
 TODO: Use async
 """
 
+import argparse
+import atexit
 import datetime
 import json
 import logging
 import os
 import socket
+import stat
 import sys
+import tempfile
+import time
 
-from geohash_tools import geohash, geohash_sqlite3
+from geohash_tools import (geohash, geohash_datasets, geohash_heatmap, geohash_polygons, geohash_singleflight,
+                           geohash_trace)
 
 DEBUG_MESSAGES = True
+MAX_REQUEST_SIZE = 4 * 1024 * 1024  # Upper bound for a single (batch) request
 daemon = True
 queries = 0
 __location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
 GEOHASH_SQLITE3_FILE = os.path.join(__location__, "./geohash_worldcities.db")
 
 geo_dict = {}
+tracer = geohash_trace.StageTimer()  # Sample rate is set with --trace-sample-rate
+profiler = geohash_trace.Profiler(tempfile.gettempdir())
+single_flight = geohash_singleflight.SingleFlight()  # Concurrent lookups of the same cell share one query
+heatmap = None  # geohash_heatmap.PrefixHeatmap, enabled with --heatmap-file
+polygon_index = None  # geohash_polygons.PolygonIndex, loaded with --polygons
+json_decoder = json.JSONDecoder()  # raw_decode tells cut short requests from invalid ones
 
 logging.basicConfig(format='%(asctime)s %(message)s',
                     level=logging.INFO)
@@ -34,9 +47,9 @@ logger = logging.getLogger()
 
 def geohash_tuple_to_json(geohash_tuple):
     try:
-        geohash_dict = {"city": geohash_tuple[0][5],
-                        "admin": geohash_tuple[0][6],
-                        "country": geohash_tuple[0][7],
+        geohash_dict = {"city": geohash_tuple[0][-3],  # Databases above precision 8 have more geohash columns
+                        "admin": geohash_tuple[0][-2],
+                        "country": geohash_tuple[0][-1],
                         "precision": geohash_tuple[1],
                         "hits": geohash_tuple[2]}
     except:
@@ -48,43 +61,180 @@ def geohash_tuple_to_json(geohash_tuple):
     return geohash_dict
 
 
-def recieve_input_from_client(connection, MAX_BUFFER_SIZE):
-    input_dict = {"cmd": None,
-                  "status": None}
+def parse_request(text):
+    """
+    Returns the request, or None if the json is only cut short and more segments are needed.
+    Raises json.JSONDecodeError for requests that can not become valid json, like two objects in one request.
+    """
+    text = text.strip()
     try:
-        input_data = connection.recv(MAX_BUFFER_SIZE)
-        input_dict = json.loads(input_data.decode("utf8"))
-        if not "cmd" in input_dict:
-            input_dict["cmd"] = "disconnect"
-            input_dict["status"] = "General error"
+        request, end = json_decoder.raw_decode(text)
+    except json.JSONDecodeError as e:
+        if e.pos >= len(text) or e.msg.startswith("Unterminated string"):
+            return None
+        raise
+    if end != len(text):
+        raise json.JSONDecodeError("Extra data", text, end)
+    return request
+
+
+def recieve_input_from_client(connection, MAX_BUFFER_SIZE, trace=None):
+    """
+    Reads segments until they hold one complete json request.
+    A request ends with } or ], so only those segments are parsed, and reads grow with the request,
+    so a large batch is parsed a few times instead of once per segment.
+    With a trace, idle is the wait for the first segment and recv the time from there to a complete request.
+    """
+    input_dict = {"cmd": "disconnect",
+                  "status": "General error"}
+    try:
+        input_data = bytearray()
+        if trace is not None:
+            stage_start = time.perf_counter()
+        while True:  # Large batch requests may arrive in several segments
+            chunk = connection.recv(max(MAX_BUFFER_SIZE, len(input_data)))
+            if not chunk:
+                return input_dict  # Client closed the connection
+            if trace is not None and not input_data:
+                trace["idle"] = time.perf_counter() - stage_start
+                stage_start = time.perf_counter()
+            input_data += chunk
+            if len(input_data) > MAX_REQUEST_SIZE:
+                return input_dict
+            if input_data.rstrip()[-1:] not in (b"}", b"]"):
+                continue
+            request = parse_request(input_data.decode("utf8"))
+            if request is not None:
+                break
+        if trace is not None:
+            trace["recv"] = time.perf_counter() - stage_start
+        if isinstance(request, dict) and "cmd" in request:
+            input_dict = request
     except UnicodeDecodeError:
         if DEBUG_MESSAGES:
             logger.error("Input incorrectly formatted, closing connection.")
-        input_dict["cmd"] = "disconnect"
         input_dict["status"] = "Input incorrectly formatted"
     except:
-        input_dict["cmd"] = "disconnect"
-        input_dict["status"] = "General error"
+        pass  # Invalid json or a socket error, input_dict is already a disconnect
     return input_dict
 
 
-def process_input(input_dict, cursor):
+def process_batch(batch_list, datasets):
+    """
+    Runs every query in the batch through process_input, returns a json list.
+    Queries that fail are returned as {"error": "message"} in their position.
+    """
+    if not isinstance(batch_list, list):
+        return "ERROR: Batch data must be a list of queries"
+    results = []
+    for item in batch_list:
+        if not isinstance(item, dict) or item.get("cmd") == "batch":
+            results.append(json.dumps({"error": "Invalid batch item"}))
+            continue
+        result = process_input(item, datasets)
+        if not result.startswith("{"):
+            result = json.dumps({"error": result})
+        results.append(result)
+    return "[" + ",".join(results) + "]"
+
+
+def process_admin_command(input_dict, datasets):
+    """
+    stats: returns query count, the loaded datasets and the per stage timing aggregates.
+    profile: profiles the request path for "data" seconds and writes a pstats file.
+    """
+    if input_dict["cmd"] == "stats":
+        return json.dumps({"queries": queries,
+                           "datasets": datasets.stats(),
+                           "single_flight": single_flight.stats(),
+                           "trace": tracer.stats()})
+    seconds = float(input_dict.get("data") or 10)
+    if not 0 < seconds <= 3600:
+        return "ERROR: Profile duration must be between 0 and 3600 seconds"
+    profile_file = profiler.start(seconds)
+    if profile_file is None:
+        return "ERROR: Profiling already running"
+    logger.info(f"Profiling for {seconds} seconds, writing {profile_file}")
+    return json.dumps({"profile": profile_file,
+                       "seconds": seconds})
+
+
+def process_region(input_dict):
+    " Returns the admin region and country that contain the lat,lon, from the admin boundary polygons. "
+    if polygon_index is None:
+        return "ERROR: No polygon file loaded, start the server with --polygons"
+    ll_split = input_dict["data"].split(",")
+    lat = float(ll_split[0])
+    lon = float(ll_split[1])
+    admin, country, method = polygon_index.lookup(lat, lon)
+    return json.dumps({"admin": admin,
+                       "country": country,
+                       "method": method})
+
+
+def query_layer(datasets, layer, _geohash, trace=None):
+    " Looks up the geohash in one dataset, layer None is the default dataset. "
+    with datasets.use(layer) as dataset:
+        # The result only depends on the characters that the database stores
+        return single_flight.do((dataset.name, _geohash[:dataset.precision]), dataset.query, _geohash, trace=trace)
+
+
+def process_layers(datasets, layers, _geohash):
+    " Looks up the geohash in every layer of the list, a layer that fails gets an error dict in its place. "
+    results = {}
+    for layer in layers:
+        try:
+            results[layer] = geohash_tuple_to_json(query_layer(datasets, layer, _geohash))
+        except KeyError:
+            results[layer] = {"error": f"Unknown layer {layer}"}
+        except Exception as e:
+            results[layer] = {"error": f"Server could not process geohash {e}"}
+    return json.dumps({"layers": results})
+
+
+def process_input(input_dict, datasets, trace=None):
+    """
+    datasets is the geohash_datasets.DatasetRegistry, the optional "layer" field selects a dataset by name
+    or a list of datasets that are all answered.
+    trace is an optional dict from tracer.start() that gets the time of each stage.
+    """
     try:
-        if input_dict["cmd"] == "geohash":
+        if input_dict["cmd"] == "batch":
+            return process_batch(input_dict["data"], datasets)
+        elif input_dict["cmd"] in ("stats", "profile"):
+            return process_admin_command(input_dict, datasets)
+        elif input_dict["cmd"] == "region":
+            return process_region(input_dict)
+        elif input_dict["cmd"] == "geohash":
             _geohash = input_dict["data"]
         elif input_dict["cmd"] == "latlon":
+            if trace is not None:
+                stage_start = time.perf_counter()
             ll_split = input_dict["data"].split(",")
             lat = float(ll_split[0])
             lon = float(ll_split[1])
             _geohash = geohash.encode(lat, lon)
+            if trace is not None:
+                trace["encode"] = time.perf_counter() - stage_start
         else:
             error_msg = "Server could not process geohash."
             logger.error(error_msg)
             return error_msg
         if len(_geohash) < 8:
             return "ERROR: Geohash shorter than 8 characters"
-        geohash_city_tuple = geohash_sqlite3.query_geohash_sqlite3(cursor, _geohash)
+        if heatmap is not None:
+            heatmap.record(_geohash)
+        layer = input_dict.get("layer")
+        if isinstance(layer, list):
+            return process_layers(datasets, layer, _geohash)
+        if layer is not None and layer not in datasets.datasets:
+            return f"ERROR: Unknown layer {layer}"
+        geohash_city_tuple = query_layer(datasets, layer, _geohash, trace=trace)
+        if trace is not None:
+            stage_start = time.perf_counter()
         geohash_city_json = json.dumps(geohash_tuple_to_json(geohash_city_tuple))
+        if trace is not None:
+            trace["json"] = time.perf_counter() - stage_start
         return geohash_city_json
     except json.JSONDecodeError as e:
         error_msg = f"Server could not process geohash: {e} "
@@ -100,18 +250,19 @@ def return_data_to_client(connection, output_data):
     connection.send(output_data.encode("utf8"))
 
 
-def client_thread(connection, ip, port, sqlite3_cursor, MAX_BUFFER_SIZE=4096):
+def client_thread(connection, ip, port, datasets, MAX_BUFFER_SIZE=4096):
     global queries
     listening = True
     while listening:
-        input_dict = recieve_input_from_client(connection, MAX_BUFFER_SIZE)
+        trace = tracer.start()
+        input_dict = recieve_input_from_client(connection, MAX_BUFFER_SIZE, trace)
         if input_dict["cmd"] == "disconnect":  # Handle disconnects here
             logger.info("Terminating Connection.")
             connection.close()
             logger.info(f"Connection from {str(ip)} ended")
             listening = False
         else:
-            geohash_json = process_input(input_dict, sqlite3_cursor)
+            geohash_json = profiler.runcall(process_input, input_dict, datasets, trace)
             # loader(loader_state) # Prints nice thing, Super slow apparently
             if daemon:
                 if queries % 3000 == 0:
@@ -121,14 +272,19 @@ def client_thread(connection, ip, port, sqlite3_cursor, MAX_BUFFER_SIZE=4096):
                     print(str(datetime.datetime.now().isoformat()) + ": Queries={}".format(str(queries)), end="\r")
             queries += 1
             try:
+                if trace is not None:
+                    stage_start = time.perf_counter()
                 return_data_to_client(connection, geohash_json)
+                if trace is not None:
+                    trace["send"] = time.perf_counter() - stage_start
+                    tracer.finish(trace)
             except BrokenPipeError:
                 logger.error(f"Client disconnected, processed {queries} queries.")
                 listening = False
                 # connection.close()
 
 
-def start_server(ip, port, sqlite3_cursor):
+def start_server(ip, port, datasets):
     from threading import Thread  # Multithreaded listener
     server_running = True
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)  # Start TCP/IP socket
@@ -148,21 +304,176 @@ def start_server(ip, port, sqlite3_cursor):
             client_ip, client_port = str(address[0]), str(address[1])
             logger.info(f"Client {client_ip} {client_port} connected.")
             try:
-                Thread(target=client_thread, args=(connection, ip, port, sqlite3_cursor)).start()
+                Thread(target=client_thread, args=(connection, ip, port, datasets)).start()
             except Exception as e:
                 logger.error(f"Could not start socket to client {client_ip}, {e}")
     except KeyboardInterrupt:
         logger.info("SIGINT shutting down server.")
+        if heatmap is not None:
+            heatmap.stop()
         server_socket.shutdown(socket.SHUT_RDWR)
         server_socket.close()
         sys.exit(0)
 
 
+def remove_unix_socket(socket_path):
+    " Removes socket_path only if it is a socket, a mistyped path never deletes a regular file. "
+    try:
+        if stat.S_ISSOCK(os.stat(socket_path).st_mode):
+            os.unlink(socket_path)
+    except FileNotFoundError:
+        pass
+
+
+def start_unix_server(socket_path, datasets):
+    " Same protocol as start_server on an AF_UNIX stream socket, for clients on the same host. "
+    from threading import Thread
+    remove_unix_socket(socket_path)  # Left behind by a previous run
+    server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        server_socket.bind(socket_path)
+    except Exception as e:
+        logger.error(f"Creating unix socket {e}")
+        sys.exit(1)
+    atexit.register(remove_unix_socket, socket_path)
+    server_socket.listen(10)
+    logger.info(f"Server listening on unix socket {socket_path}")
+    while True:
+        connection, address = server_socket.accept()
+        try:
+            Thread(target=client_thread, args=(connection, socket_path, None, datasets)).start()
+        except Exception as e:
+            logger.error(f"Could not start unix socket client, {e}")
+
+
+def start_udp_server(ip, port, datasets, MAX_DATAGRAM_SIZE=65507):
+    """
+    One request per datagram, one reply datagram per request.
+    A datagram can hold a single query or a batch, replies that do not fit in a datagram are answered with an error.
+    A request with an "id" gets the id and a newline in front of the reply, so clients can drop late replies.
+    """
+    global queries
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        server_socket.bind((ip, port))
+    except Exception as e:
+        logger.error(f"Creating udp socket {e}")
+        sys.exit(1)
+    logger.info(f"Server listening on udp port {str(port)}")
+    while True:
+        input_data, address = server_socket.recvfrom(MAX_DATAGRAM_SIZE)
+        try:
+            input_dict = json.loads(input_data.decode("utf8"))
+        except (UnicodeDecodeError, json.JSONDecodeError):
+            server_socket.sendto(b"ERROR: Input incorrectly formatted", address)
+            continue
+        if isinstance(input_dict, list):
+            input_dict = {"cmd": "batch", "data": input_dict}
+        if not isinstance(input_dict, dict) or input_dict.get("cmd") in (None, "disconnect"):
+            continue  # Nothing to disconnect from
+        request_id = input_dict.pop("id", None)
+        id_prefix = b"" if request_id is None else str(request_id).encode("utf8") + b"\n"
+        output_data = process_input(input_dict, datasets).encode("utf8")
+        queries += 1
+        if len(id_prefix) + len(output_data) > MAX_DATAGRAM_SIZE:
+            output_data = b"ERROR: Reply too large for a datagram, use a smaller batch"
+        output_data = id_prefix + output_data
+        try:
+            server_socket.sendto(output_data, address)
+        except OSError as e:
+            logger.error(f"Could not send udp reply to {address[0]}, {e}")
+
+
+def prewarm_cells(datasets, prefixes):
+    " Looks up the cells once in the default dataset so their pages are cached before the first client arrives. "
+    with datasets.use() as dataset:
+        for prefix in prefixes:
+            dataset.query(prefix.ljust(dataset.precision, "0"))
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Reverse geohash server.")
+    parser.add_argument("--ip", default="127.0.0.1", help="Address to listen on.")
+    parser.add_argument("--port", type=int, default=9999, help="TCP port for the json protocol.")
+    parser.add_argument("--database", default=GEOHASH_SQLITE3_FILE, help="SQLite3 geohash database.")
+    parser.add_argument("--datasets", default=None,
+                        help="Json config of named datasets that requests select with \"layer\", "
+                             "replaces --database, --in-memory, --warm-cache and --coverage.")
+    parser.add_argument("--http-port", type=int, default=None,
+                        help="Also serve GET /reverse, GET /geohash/<hash> and POST /batch over HTTP/1.1.")
+    parser.add_argument("--unix-socket", default=None,
+                        help="Also serve the json protocol on this unix domain socket path.")
+    parser.add_argument("--udp-port", type=int, default=None,
+                        help="Also answer json requests and batches in udp datagrams on this port.")
+    parser.add_argument("--polygons", default=None,
+                        help="GeoJSON admin boundaries for the region command.")
+    parser.add_argument("--polygon-precision", type=int, default=5,
+                        help="Geohash precision of the polygon cell index.")
+    parser.add_argument("--admin-property", default="name",
+                        help="GeoJSON feature property with the admin region name.")
+    parser.add_argument("--country-property", default="iso_a2",
+                        help="GeoJSON feature property with the country code.")
+    parser.add_argument("--in-memory", action="store_true",
+                        help="Copy the database into memory at startup.")
+    parser.add_argument("--warm-cache", action="store_true",
+                        help="Read all table and index pages at startup.")
+    parser.add_argument("--coverage", type=int, choices=(0, 4, 5), default=4,
+                        help="Precision of the coverage bitmap that rejects empty cells, 0 disables it.")
+    parser.add_argument("--heatmap-file", default=None,
+                        help="Count queried 6 character prefixes and save them to this json file.")
+    parser.add_argument("--heatmap-interval", type=int, default=60,
+                        help="Seconds between heatmap saves.")
+    parser.add_argument("--prewarm", type=int, default=1000, metavar="K",
+                        help="Look up the K most queried cells of the previous heatmap at startup.")
+    parser.add_argument("--trace-sample-rate", type=float, default=0.0,
+                        help="Fraction of socket requests to time per stage, see the stats command.")
+    parser.add_argument("--profile-dir", default=tempfile.gettempdir(),
+                        help="Directory where the profile command writes pstats files.")
+    return parser.parse_args()
+
+
 def main():
-    global geo_dict
-    logger.info(f"Starting geohash server, loading source file {GEOHASH_SQLITE3_FILE}")
-    sqlite3_cursor = geohash_sqlite3.load_sqlite3_file(GEOHASH_SQLITE3_FILE)
-    start_server("127.0.0.1", 9999, sqlite3_cursor)
+    global geo_dict, heatmap, polygon_index
+    from threading import Thread
+    args = parse_arguments()
+    tracer.sample_rate = args.trace_sample_rate
+    profiler.output_directory = args.profile_dir
+    if args.datasets:
+        logger.info(f"Starting geohash server, loading datasets from {args.datasets}")
+        datasets = geohash_datasets.load_dataset_config(args.datasets)
+    else:
+        logger.info(f"Starting geohash server, loading source file {args.database}")
+        datasets = geohash_datasets.DatasetRegistry([geohash_datasets.Dataset("default", args.database,
+                                                                              in_memory=args.in_memory,
+                                                                              warm_cache=args.warm_cache,
+                                                                              coverage=args.coverage)],
+                                                    "default")
+    datasets.preload()
+    datasets.start()
+    if args.polygons:
+        polygon_start = time.time()
+        polygon_index = geohash_polygons.load_polygon_index(args.polygons, precision=args.polygon_precision,
+                                                            admin_property=args.admin_property,
+                                                            country_property=args.country_property)
+        logger.info(f"Indexed polygons in {time.time() - polygon_start:.3f} seconds {polygon_index.stats()}")
+    if args.heatmap_file:
+        heatmap = geohash_heatmap.PrefixHeatmap(args.heatmap_file, flush_interval=args.heatmap_interval)
+        if heatmap.load() and args.prewarm:
+            prewarm_start = time.time()
+            hot_cells = heatmap.top(args.prewarm)
+            prewarm_cells(datasets, hot_cells)
+            logger.info(f"Prewarmed {len(hot_cells)} cells in {time.time() - prewarm_start:.3f} seconds")
+        heatmap.start()
+    if args.http_port:
+        import geohash_http_server
+        Thread(target=geohash_http_server.start_http_server,
+               args=(args.ip, args.http_port, datasets, process_input),
+               daemon=True).start()
+    if args.unix_socket:
+        Thread(target=start_unix_server, args=(args.unix_socket, datasets), daemon=True).start()
+    if args.udp_port:
+        Thread(target=start_udp_server, args=(args.ip, args.udp_port, datasets), daemon=True).start()
+    start_server(args.ip, args.port, datasets)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+"""
+Coverage bitmap of the geohash cells that contain at least one row in the database.
+
+One bit per 4 character prefix, 32^4 bits = 128 KB.
+The optional 5 character bitmap is 32^5 bits = 4 MB.
+
+Most random positions are in the ocean or in empty land, those can be answered
+without running the SQL cascade in query_geohash_sqlite3.
+"""
+
+from geohash_tools.geohash_sqlite3 import one_to_cell
+
+_base32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+_DECODEMAP = {}
+for i in range(len(_base32)):
+    _DECODEMAP[_base32[i]] = i
+del i
+
+
+class CoverageBitmap():
+    def __init__(self, with_five=False):
+        self.four = bytearray(32 ** 4 // 8)
+        self.five = bytearray(32 ** 5 // 8) if with_five else None
+
+    def add(self, one, five=None):
+        cell = one_to_cell(one)
+        self.four[cell >> 3] |= 1 << (cell & 7)
+        if self.five is not None and five is not None:
+            cell = cell * 32 + five
+            self.five[cell >> 3] |= 1 << (cell & 7)
+
+    def covered_precision(self, geohash):
+        """
+        Returns the highest precision that can have rows: 0 if the 4 character cell is empty,
+        4 if only the 4 character cell has rows and None if the lookup has to run the full cascade.
+        """
+        try:
+            cell = 0
+            for character in geohash[:4]:
+                cell = cell * 32 + _DECODEMAP[character]
+            if not self.four[cell >> 3] & (1 << (cell & 7)):
+                return 0
+            if self.five is not None and len(geohash) > 4:
+                cell = cell * 32 + _DECODEMAP[geohash[4]]
+                if not self.five[cell >> 3] & (1 << (cell & 7)):
+                    return 4
+        except KeyError:  # Not a valid geohash, let the database lookup report it
+            pass
+        return None
+
+
+def build_coverage_bitmap(cursor, with_five=False):
+    " Reads the distinct prefixes from the geohash table, the 4 character bitmap only needs the index. "
+    coverage = CoverageBitmap(with_five=with_five)
+    if with_five:
+        cursor.execute("SELECT DISTINCT one, five FROM geohash")
+    else:
+        cursor.execute("SELECT DISTINCT one FROM geohash")
+    for row in cursor.fetchall():
+        coverage.add(*row)
+    return coverage
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+
+"""
+Several named geohash databases served from one process.
+
+Datasets are loaded on first use and closed again when they have been idle for idle_timeout seconds,
+unless they are preloaded. The config is a json file:
+
+{"default": "worldcities",
+ "idle_timeout": 600,
+ "datasets": {"worldcities": {"path": "geohash_worldcities.db", "preload": true},
+              "geonames": {"path": "geonames.db", "in_memory": true, "coverage": 5},
+              "poi": {"path": "poi.db", "warm_cache": true}}}
+
+Relative paths are relative to the config file.
+"""
+
+import contextlib
+import json
+import logging
+import os
+import resource
+import threading
+import time
+
+from geohash_tools import geohash_coverage, geohash_sqlite3
+
+logger = logging.getLogger()
+
+
+class Dataset():
+    def __init__(self, name, sqlite3_file, in_memory=False, warm_cache=False, coverage=4, preload=False):
+        self.name = name
+        self.sqlite3_file = sqlite3_file
+        self.in_memory = in_memory
+        self.warm_cache = warm_cache
+        self.coverage_precision = coverage
+        self.preload = preload
+        self.cursor = None  # Keeps the database open, an in memory copy lives as long as one connection to it
+        self.cursors = []  # Idle cursors, every concurrent lookup takes its own
+        self.memory_name = f"geohash_dataset_{id(self)}" if in_memory else None
+        self.coverage = None  # geohash_coverage.CoverageBitmap
+        self.summary = False  # The database has a geohash_summary table
+        self.precision = 8  # Number of geohash characters stored in the database
+        self.last_used = 0.0
+        self.in_use = 0
+        self.load_lock = threading.Lock()  # Loading one dataset does not block lookups in the others
+
+    @property
+    def loaded(self):
+        return self.cursor is not None
+
+    def load(self):
+        " Opens the database and builds the coverage bitmap, logs load time and memory use. "
+        load_start = time.time()
+        cursor = geohash_sqlite3.load_sqlite3_file(self.sqlite3_file,
+                                                   in_memory=self.in_memory,
+                                                   warm_cache=self.warm_cache,
+                                                   memory_name=self.memory_name)
+        database_mb = geohash_sqlite3.sqlite3_database_size(cursor) / 1024 / 1024
+        self.summary = geohash_sqlite3.has_summary_table(cursor)
+        self.precision = geohash_sqlite3.sqlite3_precision(cursor)
+        if self.coverage_precision:
+            self.coverage = geohash_coverage.build_coverage_bitmap(cursor, with_five=self.coverage_precision == 5)
+        self.cursors = [cursor]
+        self.last_used = time.monotonic()  # Not evicted before the request that loaded it runs
+        self.cursor = cursor
+        max_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        logger.info(f"Loaded dataset {self.name} from {self.sqlite3_file} in {time.time() - load_start:.3f} seconds, "
+                    f"database size {database_mb:.1f} MB, in memory: {self.in_memory}, warm cache: {self.warm_cache}, "
+                    f"summary table: {self.summary}, precision: {self.precision}, "
+                    f"coverage: {self.coverage_precision}, max RSS {max_rss_mb:.1f} MB")
+
+    def close(self):
+        " Only called when no lookup is running, so every cursor is back in the pool. "
+        cursor, self.cursor, self.coverage = self.cursor, None, None
+        for pooled_cursor in self.cursors:
+            pooled_cursor.connection.close()
+        self.cursors = []
+        cursor.connection.close()
+        logger.info(f"Closed idle dataset {self.name}")
+
+    def query(self, geohash, trace=None):
+        " Runs on a cursor of its own, the pool grows to the number of concurrent lookups. "
+        try:
+            cursor = self.cursors.pop()  # list pop and append are atomic
+        except IndexError:
+            cursor = geohash_sqlite3.open_sqlite3_cursor(self.sqlite3_file, memory_name=self.memory_name)
+        try:
+            return geohash_sqlite3.query_geohash_sqlite3(cursor, geohash, trace=trace,
+                                                         coverage=self.coverage,
+                                                         summary=self.summary,
+                                                         precision=self.precision)
+        finally:
+            self.cursors.append(cursor)
+
+
+class DatasetRegistry():
+    def __init__(self, datasets, default, idle_timeout=600):
+        self.datasets = {dataset.name: dataset for dataset in datasets}
+        self.default = default
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        if default not in self.datasets:
+            raise ValueError(f"Default dataset {default} is not configured")
+
+    def names(self):
+        return list(self.datasets)
+
+    @contextlib.contextmanager
+    def use(self, name=None):
+        """
+        Yields the loaded dataset, None is the default dataset. Raises KeyError for unknown names.
+        A dataset is not evicted while it is in use.
+        """
+        dataset = self.datasets[name or self.default]
+        while True:
+            with self.lock:  # Only guards in_use and last_used, loading happens outside it
+                if dataset.loaded:
+                    dataset.in_use += 1
+                    break
+            with dataset.load_lock:
+                if not dataset.loaded:  # Another thread may have loaded it while this one waited
+                    dataset.load()
+        try:
+            yield dataset
+        finally:
+            with self.lock:
+                dataset.in_use -= 1
+                dataset.last_used = time.monotonic()
+
+    def preload(self):
+        for dataset in self.datasets.values():
+            if dataset.preload or dataset.name == self.default:
+                with self.use(dataset.name):
+                    pass
+
+    def evict_idle(self):
+        " Closes datasets that are not preloaded and have not been used for idle_timeout seconds. "
+        now = time.monotonic()
+        with self.lock:
+            for dataset in self.datasets.values():
+                if (dataset.loaded and not dataset.preload and dataset.name != self.default
+                        and dataset.in_use == 0 and now - dataset.last_used > self.idle_timeout):
+                    dataset.close()
+
+    def run_eviction(self):
+        stop = threading.Event()
+        while not stop.wait(max(self.idle_timeout / 4, 1)):
+            self.evict_idle()
+
+    def start(self):
+        if self.idle_timeout:
+            threading.Thread(target=self.run_eviction, daemon=True).start()
+
+    def stats(self):
+        now = time.monotonic()
+        with self.lock:
+            return {dataset.name: {"loaded": dataset.loaded,
+                                   "cursors": len(dataset.cursors),
+                                   "default": dataset.name == self.default,
+                                   "idle_seconds": round(now - dataset.last_used, 1) if dataset.last_used else None}
+                    for dataset in self.datasets.values()}
+
+
+def load_dataset_config(config_file):
+    with open(config_file, 'r') as __config_file:
+        config = json.load(__config_file)
+    config_directory = os.path.dirname(os.path.abspath(config_file))
+    datasets = []
+    for name, options in config["datasets"].items():
+        options = dict(options)
+        sqlite3_file = os.path.join(config_directory, options.pop("path"))
+        datasets.append(Dataset(name, sqlite3_file, **options))
+    default = config.get("default", datasets[0].name if datasets else None)
+    return DatasetRegistry(datasets, default, idle_timeout=config.get("idle_timeout", 600))
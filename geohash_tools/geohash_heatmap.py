@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+"""
+Histogram of the queried geohash prefixes, persisted to a json file.
+
+The request path only appends the prefix to a deque, a background thread counts them
+and writes the file every flush_interval seconds.
+On startup the most queried cells of the previous run can be looked up to warm the caches.
+
+File format: {"precision": 6, "counts": {"u6sce1": 1234, ...}}
+"""
+
+import collections
+import json
+import logging
+import os
+import threading
+
+MAX_PENDING = 1_000_000  # Prefixes waiting to be counted, the oldest are dropped if the counter falls behind
+MAX_CELLS = 100_000  # Cells kept in the file
+
+logger = logging.getLogger()
+
+
+class PrefixHeatmap():
+    def __init__(self, heatmap_file, precision=6, flush_interval=60):
+        self.heatmap_file = heatmap_file
+        self.precision = precision
+        self.flush_interval = flush_interval
+        self.pending = collections.deque(maxlen=MAX_PENDING)  # append and popleft are thread safe
+        self.counts = collections.Counter()
+        self.lock = threading.Lock()  # flush runs in the background thread and at shutdown
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def record(self, geohash):
+        self.pending.append(geohash[:self.precision])
+
+    def load(self):
+        " Reads the counts of the previous run, returns False if there is no usable file. "
+        try:
+            with open(self.heatmap_file, 'r') as __heatmap_file:
+                heatmap = json.load(__heatmap_file)
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError) as e:
+            logger.error(f"Could not read heatmap {self.heatmap_file}: {e}")
+            return False
+        if heatmap.get("precision") != self.precision:
+            logger.info(f"Heatmap {self.heatmap_file} has another precision, starting a new one.")
+            return False
+        self.counts.update(heatmap["counts"])
+        return True
+
+    def top(self, count):
+        return [prefix for prefix, hits in self.counts.most_common(count)]
+
+    def flush(self):
+        " Counts the pending prefixes and writes the file, the rename keeps the previous file intact on errors. "
+        with self.lock:
+            pending = self.pending
+            while pending:
+                self.counts[pending.popleft()] += 1
+            if len(self.counts) > MAX_CELLS:
+                self.counts = collections.Counter(dict(self.counts.most_common(MAX_CELLS)))
+            temporary_file = self.heatmap_file + ".tmp"
+            with open(temporary_file, 'w') as __heatmap_file:
+                json.dump({"precision": self.precision,
+                           "counts": dict(self.counts)}, __heatmap_file)
+            os.replace(temporary_file, self.heatmap_file)
+
+    def run(self):
+        while not self.stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except OSError as e:
+                logger.error(f"Could not write heatmap {self.heatmap_file}: {e}")
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        " Stops the background thread, waits for a flush in progress and writes the final counts. "
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.flush()
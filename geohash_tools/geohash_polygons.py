@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+"""
+Point in polygon reverse geocoding with a geohash cell index.
+
+Admin boundary polygons are read from a GeoJSON FeatureCollection of Polygon and MultiPolygon features.
+Every region is indexed by subdividing geohash cells down to the index precision:
+ * cells without any boundary edge that are inside the region are stored as inside cells, at any precision,
+ * cells at the index precision that are crossed by boundary edges are stored as boundary cells,
+   together with the edges that cross them and whether the cell center is inside.
+
+Points in inside cells are answered with dict lookups only.
+Points in boundary cells count the crossings between the point and the cell center with the few edges of that cell,
+the point is inside if the center is inside and the count is even, or the other way around.
+Holes and multipolygons work with the same even-odd rule.
+"""
+
+import json
+
+from geohash_tools import geohash
+
+_base32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+
+def cell_bounds(prefix):
+    " Returns (min_lon, min_lat, max_lon, max_lat) of a geohash cell, the empty prefix is the whole world. "
+    if not prefix:
+        return -180.0, -90.0, 180.0, 90.0
+    lat, lon, lat_err, lon_err = geohash.decode_exactly(prefix)
+    return lon - lon_err, lat - lat_err, lon + lon_err, lat + lat_err
+
+
+def segment_intersects_box(edge, bounds):
+    " Liang-Barsky clipping of the edge ((x1, y1), (x2, y2)) against the box. "
+    (x1, y1), (x2, y2) = edge
+    min_x, min_y, max_x, max_y = bounds
+    dx = x2 - x1
+    dy = y2 - y1
+    t0, t1 = 0.0, 1.0
+    for p, q in ((-dx, x1 - min_x), (dx, max_x - x1), (-dy, y1 - min_y), (dy, max_y - y1)):
+        if p == 0:
+            if q < 0:
+                return False
+        else:
+            t = q / p
+            if p < 0:
+                if t > t1:
+                    return False
+                if t > t0:
+                    t0 = t
+            else:
+                if t < t0:
+                    return False
+                if t < t1:
+                    t1 = t
+    return True
+
+
+def count_crossings(start, end, edges):
+    " Number of edges that the segment start-end properly crosses. "
+    ax, ay = start
+    bx, by = end
+    crossings = 0
+    for (cx, cy), (dx, dy) in edges:
+        d1 = (bx - ax) * (cy - ay) - (by - ay) * (cx - ax)
+        d2 = (bx - ax) * (dy - ay) - (by - ay) * (dx - ax)
+        if (d1 > 0) == (d2 > 0):
+            continue
+        d3 = (dx - cx) * (ay - cy) - (dy - cy) * (ax - cx)
+        d4 = (dx - cx) * (by - cy) - (dy - cy) * (bx - cx)
+        if (d3 > 0) != (d4 > 0):
+            crossings += 1
+    return crossings
+
+
+def geometry_rings(geometry):
+    " Returns all rings of a Polygon or MultiPolygon as lists of (lon, lat). "
+    if geometry["type"] == "Polygon":
+        polygons = [geometry["coordinates"]]
+    elif geometry["type"] == "MultiPolygon":
+        polygons = geometry["coordinates"]
+    else:
+        return []
+    return [[(float(point[0]), float(point[1])) for point in ring] for polygon in polygons for ring in polygon]
+
+
+def load_geojson_regions(geojson_file, admin_property="name", country_property="iso_a2"):
+    " Returns a list of (admin, country, rings) from a GeoJSON FeatureCollection. "
+    with open(geojson_file, 'r') as __geojson_file:
+        feature_collection = json.load(__geojson_file)
+    regions = []
+    for feature in feature_collection["features"]:
+        if not feature.get("geometry"):
+            continue
+        rings = geometry_rings(feature["geometry"])
+        if rings:
+            properties = feature.get("properties") or {}
+            regions.append((properties.get(admin_property), properties.get(country_property), rings))
+    return regions
+
+
+class PolygonIndex():
+    def __init__(self, regions, precision=5):
+        self.precision = precision
+        self.regions = []  # (admin, country)
+        self.inside = {}  # prefix -> region number, for cells without boundary edges
+        self.boundary = {}  # prefix -> [(region number, edges, center, center inside)]
+        for admin, country, rings in regions:
+            self.add_region(admin, country, rings)
+
+    def add_region(self, admin, country, rings):
+        region = len(self.regions)
+        self.regions.append((admin, country))
+        edges = [(ring[i], ring[i + 1]) for ring in rings for i in range(len(ring) - 1)]
+        if not edges:
+            return
+        xs = [point[0] for ring in rings for point in ring]
+        ys = [point[1] for ring in rings for point in ring]
+        region_bounds = (min(xs), min(ys), max(xs), max(ys))
+        outside_point = (region_bounds[0] - 1.0, region_bounds[1] - 1.0)  # Outside the bounding box, so outside
+        self.classify_cell(region, "", edges, region_bounds, outside_point, False)
+
+    def classify_cell(self, region, prefix, edges, region_bounds, reference, reference_inside):
+        """
+        edges are the edges that cross the parent cell, reference is a point in the parent cell with known status.
+        The segment from the reference to the center of this cell stays in the parent cell, so those edges are enough.
+        """
+        min_x, min_y, max_x, max_y = cell_bounds(prefix)
+        if max_x < region_bounds[0] or min_x > region_bounds[2] or max_y < region_bounds[1] or min_y > region_bounds[3]:
+            return
+        center = ((min_x + max_x) / 2, (min_y + max_y) / 2)
+        center_inside = reference_inside ^ (count_crossings(reference, center, edges) % 2 == 1)
+        cell_edges = [edge for edge in edges if segment_intersects_box(edge, (min_x, min_y, max_x, max_y))]
+        if not cell_edges:
+            if center_inside:
+                self.inside[prefix] = region
+            return
+        if len(prefix) == self.precision:
+            self.boundary.setdefault(prefix, []).append((region, cell_edges, center, center_inside))
+            return
+        for character in _base32:
+            self.classify_cell(region, prefix + character, cell_edges, region_bounds, center, center_inside)
+
+    def lookup(self, lat, lon):
+        """
+        Returns (admin, country, method), method is "cell" when the cell lookup was enough,
+        "polygon" when edges had to be tested and None when no region contains the point.
+        """
+        cell = geohash.encode(lat, lon, precision=self.precision)
+        for length in range(1, self.precision + 1):
+            region = self.inside.get(cell[:length])
+            if region is not None:
+                return self.regions[region] + ("cell",)
+        point = (lon, lat)
+        for region, edges, center, center_inside in self.boundary.get(cell, ()):
+            if center_inside ^ (count_crossings(point, center, edges) % 2 == 1):
+                return self.regions[region] + ("polygon",)
+        return None, None, None
+
+    def stats(self):
+        return {"regions": len(self.regions),
+                "inside_cells": len(self.inside),
+                "boundary_cells": len(self.boundary)}
+
+
+def load_polygon_index(geojson_file, precision=5, admin_property="name", country_property="iso_a2"):
+    return PolygonIndex(load_geojson_regions(geojson_file, admin_property, country_property), precision=precision)
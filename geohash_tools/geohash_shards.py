@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+"""
+Splits a geohash database into shards by geohash prefix ranges.
+
+A shard map is a json file:
+{"shards": [{"start": "0000", "end": "9b3x", "backends": ["127.0.0.1:10000"]},
+            {"start": "9b3x", "end": "", "backends": ["127.0.0.1:10001", "127.0.0.2:10001"]}]}
+
+start is inclusive, end is exclusive and an empty end means the rest of the world.
+The geohash alphabet is sorted, so comparing geohash strings is the same as comparing positions on the z-order curve.
+The shards are cut at 4 character boundaries so that every shard has roughly the same number of rows.
+"""
+
+import bisect
+import json
+
+from geohash_tools import geohash_sqlite3
+
+_base32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+
+def one_to_prefix(one):
+    " 12010429 -> 'd14x', the inverse of how geohash_to_int_tuple stores the first four characters. "
+    return "".join(_base32[(one // divisor) % 100] for divisor in (1000000, 10000, 100, 1))
+
+
+def prefix_to_one(prefix):
+    " Only the first four characters are used, shorter prefixes are padded with the lowest character. "
+    return geohash_sqlite3.geohash_to_int_tuple(prefix[:4].ljust(4, "0"))[0]
+
+
+def build_shard_map(cursor, shard_count, backends=None):
+    """
+    Cuts the database into shard_count prefix ranges with roughly equal row counts.
+    backends is an optional list with one list of "ip:port" strings per shard.
+    """
+    cursor.execute("SELECT one, COUNT(*) FROM geohash GROUP BY one ORDER BY one")
+    counts = cursor.fetchall()
+    total = sum(count for one, count in counts)
+    starts = [""]
+    seen = 0
+    for one, count in counts:
+        if seen >= total * len(starts) / shard_count and len(starts) < shard_count:
+            starts.append(one_to_prefix(one))
+        seen += count
+    shards = []
+    for index, start in enumerate(starts):
+        end = starts[index + 1] if index + 1 < len(starts) else ""
+        shards.append({"start": start,
+                       "end": end,
+                       "backends": backends[index] if backends else []})
+    return {"shards": shards}
+
+
+def export_shard_sqlite3(cursor, sqlite3_file, start, end):
+    " Writes the rows in the prefix range [start, end) to a new database so that a node only loads its slice. "
+    where = []
+    if start:
+        where.append(f"one >= {prefix_to_one(start)}")
+    if end:
+        where.append(f"one < {prefix_to_one(end)}")
+    precision = geohash_sqlite3.sqlite3_precision(cursor)
+    columns = ", ".join(geohash_sqlite3.GEOHASH_COLUMNS[:precision - 3] + ("city", "admin", "cc"))
+    select_query = f"SELECT {columns} FROM geohash"
+    if where:
+        select_query += " WHERE " + " AND ".join(where)
+    shard_cursor = geohash_sqlite3.load_sqlite3_file(sqlite3_file)
+    geohash_sqlite3.sqlite3_create_lite_database(shard_cursor, precision=precision)
+    cursor.execute(select_query)
+    geohash_sqlite3.batch_insert_sqlite3(shard_cursor, cursor)  # Streams the rows, the slice can be larger than RAM
+    if geohash_sqlite3.has_summary_table(cursor):  # Row ids differ in the slice, so the summary is rebuilt
+        geohash_sqlite3.create_summary_table(shard_cursor)
+    shard_cursor.connection.close()
+
+
+def load_shard_map(shard_map_file):
+    with open(shard_map_file, 'r') as __shard_map_file:
+        return json.load(__shard_map_file)
+
+
+def write_shard_map(shard_map, shard_map_file):
+    with open(shard_map_file, 'w') as __shard_map_file:
+        json.dump(shard_map, __shard_map_file, indent=2)
+
+
+class ShardRouter():
+    " Finds the shard index of a geohash with a binary search over the shard start prefixes. "
+
+    def __init__(self, shard_map):
+        self.shards = sorted(shard_map["shards"], key=lambda shard: shard["start"])
+        self.starts = [shard["start"] for shard in self.shards]
+
+    def shard_index(self, geohash):
+        return max(bisect.bisect_right(self.starts, geohash) - 1, 0)
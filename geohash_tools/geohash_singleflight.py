@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+
+"""
+Coalesces concurrent identical lookups.
+The first thread that asks for a key runs the lookup, threads that ask for the same key
+while it is running wait for it and get the same result.
+"""
+
+import threading
+
+
+class _Call():
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}  # key -> _Call in flight
+        self.lookups = 0
+        self.deduplicated = 0
+
+    def do(self, key, function, *args, **kwargs):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self.calls[key] = call
+                self.lookups += 1
+            else:
+                self.deduplicated += 1
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = function(*args, **kwargs)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.event.set()
+        return call.result
+
+    def stats(self):
+        with self.lock:
+            return {"lookups": self.lookups,
+                    "deduplicated": self.deduplicated,
+                    "in_flight": len(self.calls)}
@@ -14,6 +14,8 @@ u6s = 26 6 24
 The strucutre of the database is:
 first_four_letters,fifth,sixth,seventh,eigth,city,country
 
+Databases with a precision above 8 have the columns nine, ten, eleven and twelve after eight.
+
 sthlm = "u6sce14mqd"
 
 
@@ -30,31 +32,110 @@ for i in range(len(__base32)):
     __DECODEMAP[__base32[i]] = i
 del i
 
+GEOHASH_COLUMNS = ("one", "five", "six", "seven", "eight", "nine", "ten", "eleven", "twelve")
+MAX_PRECISION = 12
+SUMMARY_FORMAT = 2  # PRAGMA user_version of databases whose geohash_summary prefix is the base 32 cell number
+
+
+def memory_uri(memory_name):
+    " Shared cache in memory database, every connection to the uri sees the same data. "
+    return f"file:{memory_name}?mode=memory&cache=shared"
+
 
-def load_sqlite3_file(sqlite3_file):
-    " Opens sqlite3 file, returns cursor. "
+def set_read_pragmas(cursor, in_memory=False):
+    cursor.execute("PRAGMA cache_size = 100000")  # Pages in memory
+    cursor.execute("PRAGMA temp_store = MEMORY")
+    if not in_memory:
+        cursor.execute("PRAGMA mmap_size = 1073741824")  # Read pages through the OS page cache
+
+
+def load_sqlite3_file(sqlite3_file, in_memory=False, warm_cache=False, memory_name=None):
+    """
+    Opens sqlite3 file, returns cursor.
+    in_memory copies the whole database to :memory: with the backup API so no query touches the disk.
+    memory_name puts the copy in memory_uri(memory_name) instead, so open_sqlite3_cursor can open more connections to it.
+    warm_cache reads every table and index page once so the first queries do not hit cold pages.
+    """
     # if os.path.isfile(sqlite3_file):
     db = sqlite3.connect(sqlite3_file,
                          check_same_thread=False)  # This is safe since only parallel reads are being done, not writes.
+    if in_memory:
+        if memory_name is None:
+            memory_db = sqlite3.connect(":memory:", check_same_thread=False)
+        else:
+            memory_db = sqlite3.connect(memory_uri(memory_name), uri=True, check_same_thread=False)
+        db.backup(memory_db)
+        db.close()
+        db = memory_db
     cursor = db.cursor()
+    set_read_pragmas(cursor, in_memory)
+    if warm_cache:
+        warm_sqlite3_cache(cursor)
 
     return cursor
 
 
-def create_sqlite3_database(cursor):
-    "\"id\" INTEGER not null primary key,"
+def open_sqlite3_cursor(sqlite3_file, memory_name=None):
+    """
+    Opens another connection to a database that load_sqlite3_file loaded, for lookups in another thread.
+    A cursor runs one statement at a time, threads that share one crash the sqlite3 module.
+    """
+    if memory_name is None:
+        db = sqlite3.connect(sqlite3_file, check_same_thread=False)
+    else:
+        db = sqlite3.connect(memory_uri(memory_name), uri=True, check_same_thread=False)
+    cursor = db.cursor()
+    set_read_pragmas(cursor, in_memory=memory_name is not None)
+    return cursor
 
-    creation_string = """ CREATE TABLE IF NOT EXISTS geohash (
+
+def warm_sqlite3_cache(cursor):
+    " Scans every table and index once so their pages end up in the page cache. "
+    cursor.execute("SELECT type, name, tbl_name FROM sqlite_master WHERE type IN ('table', 'index')")
+    for item_type, name, table in cursor.fetchall():
+        if item_type == "table":
+            cursor.execute(f'SELECT * FROM "{table}"')
+        else:
+            cursor.execute(f'PRAGMA index_info("{name}")')
+            columns = [row[2] for row in cursor.fetchall() if row[2]]
+            if not columns:
+                continue
+            cursor.execute(f'SELECT "{columns[0]}" FROM "{table}" INDEXED BY "{name}" ORDER BY "{columns[0]}"')
+        while cursor.fetchmany(10000):
+            pass
+
+
+def sqlite3_database_size(cursor):
+    " Returns the size of the loaded database in bytes. "
+    page_count = cursor.execute("PRAGMA page_count").fetchone()[0]
+    page_size = cursor.execute("PRAGMA page_size").fetchone()[0]
+    return page_count * page_size
+
+
+def geohash_creation_string(precision=8):
+    " Stores precision characters, 4 to 12. "
+    if not 4 <= precision <= MAX_PRECISION:
+        raise ValueError(f"Precision must be between 4 and {MAX_PRECISION}")
+    columns = "".join(f"    {column} INTEGER,\n" for column in GEOHASH_COLUMNS[1:precision - 3])
+    return f""" CREATE TABLE IF NOT EXISTS geohash (
     one INTEGER not null,
-    five INTEGER,
-    six INTEGER,
-    seven INTEGER,
-    eight INTEGER,
-    city STRING,
+{columns}    city STRING,
     admin STRING,
     cc STRING
     );
     """
+
+
+def create_prefix_index(cursor, precision):
+    " Above precision 8 one composite index makes the lookup at every level a single index range. "
+    if precision > 8:
+        cursor.execute(f"CREATE INDEX prefix ON geohash({', '.join(GEOHASH_COLUMNS[:precision - 3])})")
+
+
+def create_sqlite3_database(cursor, precision=8):
+    "\"id\" INTEGER not null primary key,"
+
+    creation_string = geohash_creation_string(precision)
     try:
         cursor.execute(creation_string)
 
@@ -64,6 +145,7 @@ def create_sqlite3_database(cursor):
         cursor.execute("CREATE INDEX six ON geohash(six)")
         cursor.execute("CREATE INDEX seven ON geohash(seven)")
         cursor.execute("CREATE INDEX eight ON geohash(eight)")
+        create_prefix_index(cursor, precision)
 
         cursor.execute("PRAGMA journal_mode = OFF")  # Dont use journal
         cursor.execute("PRAGMA synchronous = 0")  # Dont flush to disk
@@ -76,25 +158,16 @@ def create_sqlite3_database(cursor):
         print("Could not create new geohash database.")
 
 
-def sqlite3_create_lite_database(cursor):
+def sqlite3_create_lite_database(cursor, precision=8):
     "\"id\" INTEGER not null primary key,"
 
-    creation_string = """ CREATE TABLE IF NOT EXISTS geohash (
-    one INTEGER not null,
-    five INTEGER,
-    six INTEGER,
-    seven INTEGER,
-    eight INTEGER,
-    city STRING,
-    admin STRING,
-    cc STRING
-    );
-    """
+    creation_string = geohash_creation_string(precision)
     try:
         cursor.execute(creation_string)
 
         # Create indexes
         cursor.execute("CREATE INDEX one ON geohash(one)")
+        create_prefix_index(cursor, precision)
 
         cursor.execute("PRAGMA journal_mode = OFF")  # Dont use journal
         cursor.execute("PRAGMA synchronous = 0")  # Dont flush to disk
@@ -118,10 +191,11 @@ def batch_insert_sqlite3(cursor, data_tuple_generator, insert_string=None, batch
 
     itemcount = 0
 
-    insert_string = f"INSERT OR IGNORE INTO geohash(one, five, six, seven, eight, city, admin, cc) VALUES(?, ?, ?, ?, ?, ?, ?, ?);"
-
     try:
         for item in data_tuple_generator:
+            if insert_string is None:  # The item has precision - 3 geohash columns and city, admin, cc
+                columns = ", ".join(GEOHASH_COLUMNS[:len(item) - 3] + ("city", "admin", "cc"))
+                insert_string = f"INSERT OR IGNORE INTO geohash({columns}) VALUES({', '.join('?' * len(item))});"
             itemcount += 1
             cursor.executemany(insert_string, (item,))
             if itemcount % batch_size == 0:
@@ -132,7 +206,7 @@ def batch_insert_sqlite3(cursor, data_tuple_generator, insert_string=None, batch
     cursor.execute("COMMIT")
 
 
-def latlon_to_geohash(latlon_string):
+def latlon_to_geohash(latlon_string, precision=10):
     """
     Format is assumed to be "50.321,20.1234"
     Splits the string in to latitude and longitude.
@@ -196,14 +270,14 @@ def latlon_to_geohash(latlon_string):
     latlon_tuple = validate_latlon(latlon_string)
 
     if latlon_tuple:
-        geohash = encode(latlon_tuple[0], latlon_tuple[1])
+        geohash = encode(latlon_tuple[0], latlon_tuple[1], precision=max(precision, 10))
     else:
         print(f"Not a valid latlon string:\t{latlon_string}")
         geohash = None
     return geohash
 
 
-def geohash_to_int_tuple(geohash_string):
+def geohash_to_int_tuple(geohash_string, precision=8):
     """
     Converts geohash to a tuple that will fit into the SQLite database.
     first_four
@@ -213,7 +287,9 @@ def geohash_to_int_tuple(geohash_string):
     six
     seven
     eight
+    nine to twelve if precision is above 8
     :param geohash:
+    :param precision: number of characters kept, the tuple has precision - 3 items
     :return:
     """
 
@@ -233,7 +309,7 @@ def geohash_to_int_tuple(geohash_string):
 
         def get_first_four(geohash, __decodemap):
             "Prune geohash"
-            geohash = geohash[:8]
+            geohash = geohash[:precision]
 
             four = geohash[:4]
             four_decoded = ""
@@ -247,32 +323,18 @@ def geohash_to_int_tuple(geohash_string):
 
         geohash_length = len(geohash)
         first_four = get_first_four(geohash, __decodemap)
-        five = 0
-        six = 0
-        seven = 0
-        eight = 0
         if first_four == None:
             return None
 
         if validate_geohash(geohash, __decodemap):
-            try:
-                five = geohash_str_to_num(geohash[4], __decodemap)
-                try:
-                    six = geohash_str_to_num(geohash[5], __decodemap)
-                    try:
-                        seven = geohash_str_to_num(geohash[6], __decodemap)
-                        try:
-                            eight = geohash_str_to_num(geohash[7], __decodemap)
-                        except IndexError:
-                            pass
-                    except IndexError:
-                        pass
-                except IndexError:
-                    pass
-            except IndexError:
-                pass
-
-            int_tuple = (first_four, five, six, seven, eight)
+            int_list = [first_four]
+            for index in range(4, precision):  # Missing characters are stored as 0
+                if index < geohash_length:
+                    int_list.append(geohash_str_to_num(geohash[index], __decodemap))
+                else:
+                    int_list.append(0)
+
+            int_tuple = tuple(int_list)
 
             return int_tuple
         else:
@@ -287,7 +349,7 @@ def geohash_to_int_tuple(geohash_string):
     return geohash_tuple
 
 
-def geohash_csv_to_tuple(geohash_csv_file, file_contains_latlon=True):
+def geohash_csv_to_tuple(geohash_csv_file, file_contains_latlon=True, precision=8):
     count = 0
     with open(geohash_csv_file, 'rb') as geohashfile:
         for line in geohashfile:
@@ -295,12 +357,12 @@ def geohash_csv_to_tuple(geohash_csv_file, file_contains_latlon=True):
                 split_line = line.decode().rstrip().split(",")
                 lat = split_line[0]
                 lon = split_line[1]
-                geohash = latlon_to_geohash(','.join([lat, lon]))
+                geohash = latlon_to_geohash(','.join([lat, lon]), precision=precision)
                 name = split_line[2]
                 city = split_line[3]
                 admin = split_line[4]
                 cc = split_line[5]
-                geohash_int_tuple = geohash_to_int_tuple(geohash)
+                geohash_int_tuple = geohash_to_int_tuple(geohash, precision=precision)
             else:
                 split_line = line.decode().rstrip().split(",")
                 geohash = split_line[0]
@@ -308,7 +370,7 @@ def geohash_csv_to_tuple(geohash_csv_file, file_contains_latlon=True):
                 city = split_line[2]
                 admin = split_line[3]
                 cc = split_line[4]
-                geohash_int_tuple = geohash_to_int_tuple(geohash)
+                geohash_int_tuple = geohash_to_int_tuple(geohash, precision=precision)
 
             # Complete the tuple
             if geohash_int_tuple:
@@ -326,8 +388,119 @@ def geohash_csv_to_tuple(geohash_csv_file, file_contains_latlon=True):
                 print(f"Error in line: {line}")
 
 
-def query_geohash_sqlite3(cursor, geohash):
-    geohash_tuple = geohash_to_int_tuple(geohash)
+def one_to_cell(one):
+    " The number of the 4 character cell, 0 to 32^4 - 1, from the 0-31 pairs in one, 12,1,4,29 = 12010429. "
+    return (((one // 1000000) * 32 + (one // 10000) % 100) * 32 + (one // 100) % 100) * 32 + one % 100
+
+
+def sqlite3_precision(cursor):
+    " Returns the number of geohash characters the database stores, 8 for the original schema. "
+    cursor.execute("PRAGMA table_info(geohash)")
+    table_columns = {row[1] for row in cursor.fetchall()}
+    precision = 4
+    while precision < MAX_PRECISION and GEOHASH_COLUMNS[precision - 3] in table_columns:
+        precision += 1
+    return precision
+
+
+def cell_order(precision):
+    """
+    The order of the rows in a cell, the middle row is the one that is returned.
+    Up to precision 8 that is rowid order, which the single column indexes give without sorting.
+    Above 8 the rows are ordered by position, which is the order of the composite prefix index.
+    """
+    if precision <= 8:
+        return "rowid"
+    return ", ".join(GEOHASH_COLUMNS[:precision - 3]) + ", rowid"
+
+
+def prefix_keys(geohash_tuple):
+    """
+    Returns (precision, prefix key) for every precision.
+    The key is the cell number in base 32, the key of a level is the key of the level above * 32 + the character.
+    At precision 12 that is 60 bits, it fits in an SQLite integer.
+    """
+    prefix_key = one_to_cell(geohash_tuple[0])
+    keys = [(4, prefix_key)]
+    for precision, value in enumerate(geohash_tuple[1:], start=5):
+        prefix_key = prefix_key * 32 + value
+        keys.append((precision, prefix_key))
+    return keys
+
+
+def has_summary_table(cursor):
+    " Only summary tables in the current format are used, older ones would find nothing. "
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'geohash_summary'")
+    if cursor.fetchone() is None:
+        return False
+    if cursor.execute("PRAGMA user_version").fetchone()[0] != SUMMARY_FORMAT:
+        print("Ignoring geohash_summary table in an old format, rebuild it with create_summary_table.")
+        return False
+    return True
+
+
+def create_summary_table(cursor):
+    """
+    Stores the number of rows and the row id of the middle row (in cell_order, the order the cascade returns them)
+    of every cell at every precision, so a lookup reads one small row instead of the whole cell.
+    Rebuild it after inserting rows.
+    """
+    precision_stored = sqlite3_precision(cursor)
+    order = cell_order(precision_stored)
+    cursor.execute("DROP TABLE IF EXISTS geohash_summary")
+    cursor.execute(""" CREATE TABLE geohash_summary (
+    precision INTEGER not null,
+    prefix INTEGER not null,
+    hits INTEGER not null,
+    row INTEGER not null,
+    PRIMARY KEY (precision, prefix)
+    ) WITHOUT ROWID;
+    """)
+    prefix_expression = "(((one / 1000000) * 32 + (one / 10000) % 100) * 32 + (one / 100) % 100) * 32 + one % 100"
+    for precision in range(4, precision_stored + 1):
+        if precision > 4:
+            prefix_expression = f"({prefix_expression}) * 32 + {GEOHASH_COLUMNS[precision - 4]}"
+        cursor.execute(f"""INSERT INTO geohash_summary(precision, prefix, hits, row)
+        SELECT {precision}, prefix, hits, rowid FROM (
+            SELECT rowid, {prefix_expression} AS prefix,
+                   ROW_NUMBER() OVER (PARTITION BY {prefix_expression} ORDER BY {order}) - 1 AS position,
+                   COUNT(*) OVER (PARTITION BY {prefix_expression}) AS hits
+            FROM geohash)
+        WHERE position = hits / 2;""")
+    cursor.execute("COMMIT")
+    cursor.execute(f"PRAGMA user_version = {SUMMARY_FORMAT}")
+
+
+def query_summary_sqlite3(cursor, geohash_tuple, precision=MAX_PRECISION):
+    " The whole cascade is one primary key lookup per level in geohash_summary, then one rowid lookup. "
+    keys = [key for key in prefix_keys(geohash_tuple) if key[0] <= precision]
+    if not keys:
+        return None, 0, 0
+    where = " OR ".join("(precision = ? AND prefix = ?)" for key in keys)  # Planned as one primary key search per level
+    cursor.execute(f"SELECT precision, hits, row FROM geohash_summary WHERE {where} ORDER BY precision DESC LIMIT 1;",
+                   [item for key in keys for item in key])
+    summary_row = cursor.fetchone()
+    if summary_row is None:
+        return None, 0, 0
+    precision, hits, row = summary_row
+    cursor.execute("SELECT * FROM geohash WHERE rowid = ?;", (row,))
+    return cursor.fetchone(), precision, hits
+
+
+def query_geohash_sqlite3(cursor, geohash, trace=None, coverage=None, summary=False, precision=8):
+    """
+    Returns the middle row of the most precise matching cell, the precision and the number of rows in the cell.
+    trace is an optional dict that gets the time spent in int_tuple and sql, see geohash_trace.
+    coverage is an optional geohash_coverage.CoverageBitmap that rejects empty cells without any query.
+    summary uses the geohash_summary table, see create_summary_table, instead of reading whole cells.
+    precision is the number of characters the database stores, see sqlite3_precision.
+    """
+    if trace is not None:
+        stage_start = time.perf_counter()
+    geohash_tuple = geohash_to_int_tuple(geohash, precision=precision)
+    if trace is not None:
+        trace["int_tuple"] = time.perf_counter() - stage_start
+        stage_start = time.perf_counter()
     data = None
 
     def get_location(select_query):
@@ -338,41 +511,45 @@ def query_geohash_sqlite3(cursor, geohash):
         else:
             return data
 
-    " Yes this might look ugly but it works. "
-    precision = 8
-    select_query = f"SELECT * FROM geohash WHERE one = {geohash_tuple[0]} AND five = {geohash_tuple[1]} AND six = {geohash_tuple[2]} AND seven = {geohash_tuple[3]} AND eight = {geohash_tuple[4]};"
-    data = get_location(select_query)
-    if not data:
-        precision = 7
-        select_query = f"SELECT * FROM geohash WHERE one = {geohash_tuple[0]} AND five = {geohash_tuple[1]} AND six = {geohash_tuple[2]} AND seven = {geohash_tuple[3]} ;"
-        data = get_location(select_query)
-        if not data:
-            precision = 6
-            select_query = f"SELECT * FROM geohash WHERE one = {geohash_tuple[0]} AND five = {geohash_tuple[1]} AND six = {geohash_tuple[2]};"
-            data = get_location(select_query)
-            if not data:
-                precision = 5
-                select_query = f"SELECT * FROM geohash WHERE one = {geohash_tuple[0]} AND five = {geohash_tuple[1]} ;"
-                data = get_location(select_query)
-                if not data:
-                    precision = 4
-                    select_query = f"SELECT * FROM geohash WHERE one = {geohash_tuple[0]} ;"
-                    data = get_location(select_query)
-    if data:
-        hits = len(data)
-        one_data_item = data[int(len(data) / 2)]
+    order = "" if precision <= 8 else f" ORDER BY {cell_order(precision)}"
+    precision = min(precision, len(geohash))
+    if coverage is not None:  # Skip the levels that the coverage bitmap knows are empty
+        covered_precision = coverage.covered_precision(geohash)
+        if covered_precision is not None:
+            precision = covered_precision
+    if summary:
+        one_data_item, precision, hits = query_summary_sqlite3(cursor, geohash_tuple, precision)
     else:
-        precision = 0
-        hits = 0
-        one_data_item = None
+        while precision >= 4:
+            where = " AND ".join(f"{column} = {value}"
+                                 for column, value in zip(GEOHASH_COLUMNS[:precision - 3], geohash_tuple))
+            select_query = f"SELECT * FROM geohash WHERE {where}{order};"
+            data = get_location(select_query)
+            if data:
+                break
+            precision -= 1
+        if data:
+            hits = len(data)
+            one_data_item = data[int(len(data) / 2)]
+        else:
+            precision = 0
+            hits = 0
+            one_data_item = None
+    if trace is not None:
+        trace["sql"] = time.perf_counter() - stage_start
     return one_data_item, precision, hits
 
 
-def create_sqlite_from_csv(csv_file="./csv_data/worldcities_formatted.csv", sqlite3_file="./geohash_worldcities.db"):
-    __gen = geohash_csv_to_tuple(csv_file)
+def create_sqlite_from_csv(csv_file="./csv_data/worldcities_formatted.csv", sqlite3_file="./geohash_worldcities.db",
+                           precision=8):
+    " precision is the number of geohash characters stored and indexed, 4 to 12. "
+    __gen = geohash_csv_to_tuple(csv_file, precision=precision)
     cursor = load_sqlite3_file(sqlite3_file)
-    sqlite3_create_lite_database(cursor)
+    sqlite3_create_lite_database(cursor, precision=precision)
     now = time.time()
 
     batch_insert_sqlite3(cursor, __gen)
     print(f"Insertion took {time.time() - now} seconds")
+    now = time.time()
+    create_summary_table(cursor)
+    print(f"Summary table took {time.time() - now} seconds")
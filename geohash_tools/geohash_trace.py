@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+"""
+Opt-in request tracing and on demand profiling for the geohash server.
+
+StageTimer samples a fraction of the requests and times each stage of them:
+idle (waiting for the client to send), recv, encode, int_tuple, sql, json and send.
+A trace is a plain dict of stage -> seconds, None means that the request is not sampled.
+
+Profiler runs cProfile on the request path of the client threads for a number of seconds
+and writes one pstats file.
+"""
+
+import cProfile
+import logging
+import os
+import pstats
+import random
+import threading
+import time
+
+logger = logging.getLogger()
+
+STAGES = ("idle", "recv", "encode", "int_tuple", "sql", "json", "send")
+
+
+class StageTimer():
+    def __init__(self, sample_rate=0.0):
+        self.sample_rate = sample_rate
+        self.lock = threading.Lock()
+        self.stages = {}  # stage -> [count, total seconds, max seconds]
+        self.sampled = 0
+
+    def start(self):
+        " Returns a new trace if this request is sampled, else None. "
+        if self.sample_rate and random.random() < self.sample_rate:
+            return {}
+        return None
+
+    def finish(self, trace):
+        " Adds the stages of a finished trace to the aggregates. "
+        if not trace:
+            return
+        with self.lock:
+            self.sampled += 1
+            for stage, seconds in trace.items():
+                aggregate = self.stages.setdefault(stage, [0, 0.0, 0.0])
+                aggregate[0] += 1
+                aggregate[1] += seconds
+                if seconds > aggregate[2]:
+                    aggregate[2] = seconds
+
+    def stats(self):
+        " Returns the aggregates in milliseconds, ordered as the request path. "
+        with self.lock:
+            stages = {}
+            for stage in sorted(self.stages, key=lambda s: STAGES.index(s) if s in STAGES else len(STAGES)):
+                count, total, maximum = self.stages[stage]
+                stages[stage] = {"count": count,
+                                 "total_ms": round(total * 1000, 3),
+                                 "mean_ms": round(total * 1000 / count, 4),
+                                 "max_ms": round(maximum * 1000, 3)}
+            return {"sample_rate": self.sample_rate,
+                    "sampled": self.sampled,
+                    "stages": stages}
+
+
+class Profiler():
+    """
+    Only one cProfile profile can be enabled at a time on Python 3.12 and later,
+    so one request at a time is profiled and requests that arrive meanwhile run unprofiled.
+    The session profile is written when the session ends.
+    """
+
+    def __init__(self, output_directory):
+        self.output_directory = output_directory
+        self.profiling_lock = threading.Lock()  # Held while a request is profiled
+        self.session_lock = threading.Lock()  # Guards active, profile and profiled_calls
+        self.active = False
+        self.profile = None
+        self.profiled_calls = 0
+
+    def start(self, seconds):
+        """
+        Starts a profiling session, returns the path of the pstats file it will write or None if busy.
+        Runs inside runcall when a profiled request starts a session, so it only takes the session lock.
+        """
+        with self.session_lock:
+            if self.active:
+                return None
+            self.active = True
+            self.profile = cProfile.Profile()
+            self.profiled_calls = 0
+            output_file = os.path.join(self.output_directory,
+                                       f"geohash_profile_{time.strftime('%Y%m%d_%H%M%S')}.pstats")
+        timer = threading.Timer(seconds, self.stop, args=(output_file,))
+        timer.daemon = True
+        timer.start()
+        return output_file
+
+    def runcall(self, function, *args, **kwargs):
+        if not self.active or not self.profiling_lock.acquire(blocking=False):
+            return function(*args, **kwargs)
+        try:
+            with self.session_lock:
+                profile = self.profile if self.active else None
+            if profile is None:
+                return function(*args, **kwargs)
+            try:
+                profile.enable()
+            except ValueError:  # Another profiler, like a debugger or coverage, is active
+                return function(*args, **kwargs)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                profile.disable()
+                with self.session_lock:
+                    self.profiled_calls += 1
+        finally:
+            self.profiling_lock.release()
+
+    def stop(self, output_file):
+        with self.profiling_lock:  # Waits for the request that is being profiled
+            with self.session_lock:
+                self.active = False
+                profile, profiled_calls, self.profile = self.profile, self.profiled_calls, None
+        if not profiled_calls:
+            logger.info(f"No requests were profiled, {output_file} not written.")
+            return
+        pstats.Stats(profile).dump_stats(output_file)
+        logger.info(f"Wrote profile {output_file}")